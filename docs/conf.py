@@ -23,9 +23,14 @@
 from typing import Optional
 import datetime
 import inspect
+import io
 import os
 import sys
-import toml
+
+try:
+    import tomllib
+except ImportError:
+    import tomli as tomllib
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 repo_root = os.path.abspath(os.path.join(this_dir, ".."))
@@ -45,8 +50,8 @@ extensions = [
 templates_path = []
 source_suffix = ".rst"
 
-with open(os.path.join(repo_root, "pyproject.toml"), "r") as f:
-    pyproject = toml.load(f)
+with open(os.path.join(repo_root, "pyproject.toml"), "rb") as f:
+    pyproject = tomllib.load(f)
 
 # The master toctree document.
 master_doc = "index"
@@ -82,9 +87,25 @@ intersphinx_mapping = {
     "bleak": ("https://bleak.readthedocs.io/en/latest/", None),
 }
 
+
+def _write_if_changed(path: str, content: str):
+    # rewriting an unchanged file bumps its mtime,
+    # which invalidates the sphinx environment on every build
+    try:
+        with open(path, "r") as f:
+            if f.read() == content:
+                return
+    except FileNotFoundError:
+        pass
+
+    with open(path, "w") as f:
+        f.write(content)
+
+
 parser = get_parser(DEFAULT_CONFIG)
-with open(os.path.join(this_dir, "cli.txt"), "w") as f:
-    parser.print_help(f)
+cli_help = io.StringIO()
+parser.print_help(cli_help)
+_write_if_changed(os.path.join(this_dir, "cli.txt"), cli_help.getvalue())
 
 
 def linkcode_resolve(domain: str, info: dict) -> Optional[str]:
@@ -4,6 +4,8 @@ from bleak import BleakGATTCharacteristic
 from bleak.backends.device import BLEDevice
 from bleak.backends.scanner import AdvertisementData
 from typing import Any, Awaitable, Callable
+from typing import List
+from typing import Mapping
 from typing import MutableMapping
 from typing import Optional
 from typing import Tuple
@@ -11,8 +13,10 @@ from typing import Union
 from inspect import signature
 import asyncio
 import logging
+import random
 import struct
 import sys
+import time
 
 
 _UUID_HEIGHT: str = "99fa0021-338a-1024-8a49-009c0215f78a"
@@ -21,33 +25,69 @@ _UUID_REFERENCE_INPUT: str = "99fa0031-338a-1024-8a49-009c0215f78a"
 _UUID_ADV_SVC: str = "99fa0001-338a-1024-8a49-009c0215f78a"
 _UUID_DPG: str = "99fa0011-338a-1024-8a49-009c0215f78a"
 
-_COMMAND_REFERENCE_INPUT_STOP: bytearray = bytearray([0x01, 0x80])
-_COMMAND_UP: bytearray = bytearray([0x47, 0x00])
-_COMMAND_DOWN: bytearray = bytearray([0x46, 0x00])
-_COMMAND_STOP: bytearray = bytearray([0xFF, 0x00])
-_COMMAND_WAKEUP: bytearray = bytearray([0xFE, 0x00])
+_COMMAND_REFERENCE_INPUT_STOP: bytes = b"\x01\x80"
+_COMMAND_UP: bytes = b"\x47\x00"
+_COMMAND_DOWN: bytes = b"\x46\x00"
+_COMMAND_STOP: bytes = b"\xff\x00"
+_COMMAND_WAKEUP: bytes = b"\xfe\x00"
+
+# https://github.com/rhyst/linak-controller/issues/32#issuecomment-1784055470
+_DPG_WAKEUP_A: bytes = b"\x7f\x86\x00"
+_DPG_WAKEUP_B: bytes = (
+    b"\x7f\x86\x80\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d\x0e\x0f\x10\x11"
+)
+
+# height (unsigned) and speed (signed), both little endian
+_HS_STRUCT = struct.Struct("<Hh")
+_H_STRUCT = struct.Struct("<H")
+_unpack_hs = _HS_STRUCT.unpack_from
 
 
 # height calculation offset in meters, assumed to be the same for all desks
-def _bytes_to_meters_and_speed(raw: bytearray) -> Tuple[float, float]:
-    """Converts a value read from the desk in bytes to height in meters and speed."""
-    raw_len = len(raw)
-    expected_len = 4
-    assert raw_len == expected_len, (
-        f"Expected raw value to be {expected_len} bytes long, got {raw_len} bytes"
-    )
+_MIN_HEIGHT: float = 0.62
+# the same offset in the raw units used by the desk (0.1 mm)
+_MIN_HEIGHT_RAW: int = round(_MIN_HEIGHT * 10000)
 
-    int_raw, speed_raw = struct.unpack("<Hh", raw)
-    meters = float(int(int_raw) / 10000) + IdasenDesk.MIN_HEIGHT
-    speed = float(int(speed_raw) / 10000)
+# a desk at rest this close to the target has reached it, in raw units (5 mm)
+_TARGET_TOLERANCE_RAW: int = 50
 
-    return meters, speed
+# height and speed read or notified this recently are reused, in seconds
+_HEIGHT_CACHE_TTL: float = 0.05
 
+# a sample of the desk at rest this recent is its starting height, in seconds
+_AT_REST_MAX_AGE: float = 0.2
+
+# samples waiting for a slow monitor callback, older ones are dropped
+_MONITOR_QUEUE_SIZE: int = 8
+
+
+def _unpack_raw(raw: bytearray) -> Tuple[int, int]:
+    """Unpacks a value read from the desk into raw height and speed integers."""
+    # skip the length check entirely when running with -O
+    if __debug__:
+        raw_len = len(raw)
+        expected_len = 4
+        assert raw_len == expected_len, (
+            f"Expected raw value to be {expected_len} bytes long, got {raw_len} bytes"
+        )
+
+    return _unpack_hs(raw)
+
+
+def _scale(int_raw: int, speed_raw: int) -> Tuple[float, float]:
+    """Scales raw height and speed integers to meters and meters per second."""
+    return int_raw / 10000 + _MIN_HEIGHT, speed_raw / 10000
+
+
+def _bytes_to_meters_and_speed(raw: bytearray) -> Tuple[float, float]:
+    """Converts a value read from the desk in bytes to height in meters and speed."""
+    return _scale(*_unpack_raw(raw))
 
-def _meters_to_bytes(meters: float) -> bytearray:
+
+def _meters_to_bytes(meters: float) -> bytes:
     """Converts meters to bytes for setting the position on the desk"""
-    int_raw: int = int((meters - IdasenDesk.MIN_HEIGHT) * 10000)
-    return bytearray(struct.pack("<H", int_raw))
+    int_raw: int = round(meters * 10000) - _MIN_HEIGHT_RAW
+    return _H_STRUCT.pack(int_raw)
 
 
 def _is_desk(device: BLEDevice, adv: AdvertisementData) -> bool:
@@ -57,10 +97,15 @@ def _is_desk(device: BLEDevice, adv: AdvertisementData) -> bool:
 class _DeskLoggingAdapter(logging.LoggerAdapter):
     """Prepends logging messages with the desk MAC address."""
 
+    def __init__(self, logger: logging.Logger, extra: Mapping[str, Any]):
+        super().__init__(logger, extra)
+        # the MAC address never changes, build the prefix once
+        self._prefix = f"[{extra['mac']}] "
+
     def process(
         self, msg: str, kwargs: MutableMapping[str, Any]
     ) -> Tuple[str, MutableMapping[str, Any]]:
-        return f"[{self.extra['mac']}] {msg}", kwargs  # type: ignore
+        return self._prefix + msg, kwargs
 
 
 class IdasenDesk:
@@ -77,8 +122,12 @@ class IdasenDesk:
             this client object.
 
     Note:
-        There is no locking to prevent you from running multiple movement
-        coroutines simultaneously.
+        Only one :py:meth:`move_to_target` runs at a time, additional calls
+        return immediately while the desk is moving.
+        Commands sent by :py:meth:`move_up`, :py:meth:`move_down` and
+        :py:meth:`stop` are written one at a time, but nothing prevents you
+        from running them simultaneously, or while :py:meth:`move_to_target`
+        is moving the desk; the desk acts on whichever command arrives last.
 
     Example:
         Basic Usage::
@@ -91,7 +140,7 @@ class IdasenDesk:
     """
 
     #: Minimum desk height in meters.
-    MIN_HEIGHT: float = 0.62
+    MIN_HEIGHT: float = _MIN_HEIGHT
 
     #: Maximum desk height in meters.
     MAX_HEIGHT: float = 1.27
@@ -99,6 +148,9 @@ class IdasenDesk:
     #: Number of times to retry upon failure to connect.
     RETRY_COUNT: int = 3
 
+    #: Maximum time in seconds that :py:meth:`move_to_target` moves the desk.
+    MOVE_TIMEOUT: float = 30.0
+
     def __init__(
         self,
         mac: Union[BLEDevice, str],
@@ -116,6 +168,25 @@ class IdasenDesk:
         )
         self._moving = False
         self._move_task: Optional[asyncio.Task] = None
+        # set once the move task runs, it then sends the stop commands itself
+        self._move_started = False
+        # created on first use, on Python 3.9 a lock binds to the current loop
+        self._move_lock: Optional[asyncio.Lock] = None
+        self._notifying = False
+        self._height_listeners: List[Callable[[bytearray], Awaitable[None]]] = []
+        # resolved to characteristic objects on connect
+        self._chr_height: Union[BleakGATTCharacteristic, str] = _UUID_HEIGHT
+        self._chr_command: Union[BleakGATTCharacteristic, str] = _UUID_COMMAND
+        self._chr_reference_input: Union[BleakGATTCharacteristic, str] = (
+            _UUID_REFERENCE_INPUT
+        )
+        self._chr_dpg: Union[BleakGATTCharacteristic, str] = _UUID_DPG
+        # (monotonic time, height, speed) of the latest sample
+        self._height_cache: Optional[Tuple[float, float, float]] = None
+        self._monitor_tasks: List[asyncio.Task] = []
+        # keeps writes to the command characteristic from interleaving,
+        # created on first use like the move lock
+        self._cmd_lock: Optional[asyncio.Lock] = None
 
     async def __aenter__(self):
         await self.connect()
@@ -153,7 +224,10 @@ class IdasenDesk:
         i = 0
         while True:
             try:
+                self._notifying = False
+                self._height_cache = None
                 await self._client.connect()
+                self._resolve_characteristics()
                 await self.wakeup()
                 return
             except Exception:
@@ -164,9 +238,12 @@ class IdasenDesk:
                     raise
                 i += 1
                 self._logger.warning(
-                    f"Failed to connect, retrying ({i}/{self.RETRY_COUNT})..."
+                    "Failed to connect, retrying (%d/%d)...", i, self.RETRY_COUNT
                 )
-                await asyncio.sleep(0.3 * i)
+                # exponential backoff, retry quickly after transient failures
+                # with jitter so several desks do not retry in lockstep
+                delay = min(0.1 * 2 ** (i - 1), 2.0)
+                await asyncio.sleep(delay * random.uniform(1.0, 1.5))
 
     async def disconnect(self):
         """
@@ -183,12 +260,65 @@ class IdasenDesk:
         >>> asyncio.run(example())
         False
         """
+        self._height_listeners.clear()
+        self._notifying = False
+        for task in self._monitor_tasks:
+            task.cancel()
+        await asyncio.gather(*self._monitor_tasks, return_exceptions=True)
+        self._monitor_tasks.clear()
         await self._client.disconnect()
 
-    async def monitor(self, callback: Callable[..., Awaitable[None]]):
-        output_service_uuid = "99fa0020-338a-1024-8a49-009c0215f78a"
-        output_char_uuid = "99fa0021-338a-1024-8a49-009c0215f78a"
+    def _resolve_characteristics(self) -> None:
+        """
+        Look up the characteristics once per connection.
+
+        Passing the characteristic objects to bleak avoids resolving the UUID
+        against the GATT database on every read and write.
+        Characteristics that are not found keep being addressed by UUID,
+        so bleak reports the error when they are used.
+        """
+        services = self._client.services
+        self._chr_height = services.get_characteristic(_UUID_HEIGHT) or _UUID_HEIGHT
+        self._chr_command = services.get_characteristic(_UUID_COMMAND) or _UUID_COMMAND
+        self._chr_reference_input = (
+            services.get_characteristic(_UUID_REFERENCE_INPUT) or _UUID_REFERENCE_INPUT
+        )
+        self._chr_dpg = services.get_characteristic(_UUID_DPG) or _UUID_DPG
+
+    def _command_lock(self) -> asyncio.Lock:
+        """Lock for the command characteristic, created in the running loop."""
+        if self._cmd_lock is None:
+            self._cmd_lock = asyncio.Lock()
+        return self._cmd_lock
+
+    async def _on_height_notify(self, char: BleakGATTCharacteristic, data: bytearray):
+        self._height_cache = (time.monotonic(), *_bytes_to_meters_and_speed(data))
+        for listener in tuple(self._height_listeners):
+            await listener(data)
+
+    async def _add_height_listener(
+        self, listener: Callable[[bytearray], Awaitable[None]]
+    ) -> None:
+        """
+        Register a listener for height notifications.
+
+        All listeners share a single notification subscription, which is
+        started on first use and kept for the rest of the connection.
+        """
+        self._height_listeners.append(listener)
+        if not self._notifying:
+            self._notifying = True
+            self._logger.debug("Starting notify")
+            try:
+                await self._client.start_notify(
+                    self._chr_height, self._on_height_notify
+                )
+            except BaseException:
+                self._notifying = False
+                self._height_listeners.remove(listener)
+                raise
 
+    async def monitor(self, callback: Callable[..., Awaitable[None]]):
         # Determine the amount of callback parameters
         # 1st one is height, optional 2nd one is speed, more is not supported
         callback_param_count = len(signature(callback).parameters)
@@ -198,41 +328,60 @@ class IdasenDesk:
             )
 
         return_speed_value = callback_param_count == 2
-        previous_height = 0.0
-        previous_speed = 0.0
 
-        async def output_listener(char: BleakGATTCharacteristic, data: bytearray):
-            height, speed = _bytes_to_meters_and_speed(data)
-            self._logger.debug(f"Got data: {height}m {speed}m/s")
-
-            nonlocal previous_height
-            nonlocal previous_speed
-            if abs(height - previous_height) < 0.001 and (
-                not return_speed_value or abs(speed - previous_speed) < 0.001
+        # bind to locals, the listener runs for every notification
+        unpack = _unpack_raw
+        scale = _scale
+        log_debug = self._logger.debug
+        # 0.001 meters (per second) in the raw units reported by the desk
+        threshold = 10
+
+        # start out of range so that the first notification is always reported
+        previous_height_raw = -threshold
+        previous_speed_raw = -threshold
+
+        # the callback runs in its own task so that a slow callback does not
+        # hold up the notification dispatch
+        queue: asyncio.Queue = asyncio.Queue(maxsize=_MONITOR_QUEUE_SIZE)
+
+        async def worker():
+            while True:
+                args = await queue.get()
+                try:
+                    await callback(*args)
+                except Exception:
+                    self._logger.exception("Monitor callback failed")
+
+        async def output_listener(data: bytearray):
+            nonlocal previous_height_raw
+            nonlocal previous_speed_raw
+
+            # compare the raw integers to skip scaling unchanged values
+            height_raw, speed_raw = unpack(data)
+            if abs(height_raw - previous_height_raw) < threshold and (
+                not return_speed_value
+                or abs(speed_raw - previous_speed_raw) < threshold
             ):
                 return
-            previous_height = height
-            previous_speed = speed
-
-            if return_speed_value:
-                await callback(height, speed)
-            else:
-                await callback(height)
+            previous_height_raw = height_raw
+            previous_speed_raw = speed_raw
 
-        for service in self._client.services:
-            if service.uuid != output_service_uuid:
-                continue
+            height, speed = scale(height_raw, speed_raw)
+            log_debug("Got data: %sm %sm/s", height, speed)
 
-            chr_output = service.get_characteristic(output_char_uuid)
-            if chr_output is None:
-                self._logger.error("No output characteristic found")
-                return
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait((height, speed) if return_speed_value else (height,))
 
-            self._logger.debug("Starting notify")
-            await self._client.start_notify(chr_output, output_listener)
-            return
-
-        self._logger.error("Output service not found")
+        # keep a reference, the event loop only holds weak references to tasks
+        task = asyncio.create_task(worker())
+        self._monitor_tasks.append(task)
+        try:
+            await self._add_height_listener(output_listener)
+        except BaseException:
+            task.cancel()
+            self._monitor_tasks.remove(task)
+            raise
 
     @property
     def is_connected(self) -> bool:
@@ -279,14 +428,11 @@ class IdasenDesk:
         ...         await desk.wakeup()
         >>> asyncio.run(example())
         """
-        # https://github.com/rhyst/linak-controller/issues/32#issuecomment-1784055470
-        await self._client.write_gatt_char(_UUID_DPG, b"\x7f\x86\x00")
-        await self._client.write_gatt_char(
-            _UUID_DPG,
-            b"\x7f\x86\x80\x01\x02\x03\x04\x05\x06\x07\x08\x09\x0a\x0b\x0c\x0d"
-            b"\x0e\x0f\x10\x11",
-        )
-        await self._client.write_gatt_char(_UUID_COMMAND, _COMMAND_WAKEUP)
+        # sent in order and acknowledged, as in the reference implementation
+        await self._client.write_gatt_char(self._chr_dpg, _DPG_WAKEUP_A)
+        await self._client.write_gatt_char(self._chr_dpg, _DPG_WAKEUP_B)
+        async with self._command_lock():
+            await self._client.write_gatt_char(self._chr_command, _COMMAND_WAKEUP)
 
     async def move_up(self):
         """
@@ -300,7 +446,11 @@ class IdasenDesk:
         ...         await desk.move_up()
         >>> asyncio.run(example())
         """
-        await self._client.write_gatt_char(_UUID_COMMAND, _COMMAND_UP, response=False)
+        self._height_cache = None
+        async with self._command_lock():
+            await self._client.write_gatt_char(
+                self._chr_command, _COMMAND_UP, response=False
+            )
 
     async def move_down(self):
         """
@@ -314,7 +464,11 @@ class IdasenDesk:
         ...         await desk.move_down()
         >>> asyncio.run(example())
         """
-        await self._client.write_gatt_char(_UUID_COMMAND, _COMMAND_DOWN, response=False)
+        self._height_cache = None
+        async with self._command_lock():
+            await self._client.write_gatt_char(
+                self._chr_command, _COMMAND_DOWN, response=False
+            )
 
     async def move_to_target(self, target: float):
         """
@@ -342,55 +496,140 @@ class IdasenDesk:
                 f"{self.MIN_HEIGHT:.3f}"
             )
 
-        if self._moving:
+        if self._move_lock is None:
+            self._move_lock = asyncio.Lock()
+        elif self._move_lock.locked():
             self._logger.error("Already moving")
             return
-        self._moving = True
 
         async def do_move() -> None:
-            current_height = await self.get_height()
+            self._move_started = True
+            try:
+                await move()
+            except asyncio.CancelledError:
+                await self._stop()
+                raise
+
+        async def move() -> None:
+            # a recent sample of the desk at rest saves a read when it is
+            # already at the target
+            cache = self._height_cache
+            if (
+                cache is not None
+                and cache[2] == 0
+                and time.monotonic() - cache[0] < _AT_REST_MAX_AGE
+            ):
+                current_height = cache[1]
+            else:
+                current_height = await self.get_height()
             if current_height == target:
                 return
 
             # Wakeup and stop commands are needed in order to
             # start the reference input for setting the position
-            await self._client.write_gatt_char(_UUID_COMMAND, _COMMAND_WAKEUP)
-            await self._client.write_gatt_char(_UUID_COMMAND, _COMMAND_STOP)
+            async with self._command_lock():
+                await self._client.write_gatt_char(self._chr_command, _COMMAND_WAKEUP)
+                await self._client.write_gatt_char(self._chr_command, _COMMAND_STOP)
 
             data = _meters_to_bytes(target)
-
-            while self._moving:
-                await self._client.write_gatt_char(_UUID_REFERENCE_INPUT, data)
-                await asyncio.sleep(0.2)
-
-                # Stop as soon as the speed is 0,
-                # which means the desk has reached the target position
-                speed = await self.get_speed()
-                if speed == 0:
-                    break
-
-        self._move_task = asyncio.create_task(do_move())
-        await self._move_task
-        self._moving = False
+            (target_raw,) = _H_STRUCT.unpack(data)
+
+            # The desk notifies height and speed changes while it is moving,
+            # use them to detect when it stops instead of reading the speed.
+            stopped = asyncio.Event()
+            notified = False
+            moved = False
+
+            async def on_height(raw: bytearray):
+                nonlocal notified, moved
+                height_raw, speed_raw = _unpack_raw(raw)
+                if speed_raw != 0:
+                    moved = True
+                elif not moved and abs(height_raw - target_raw) > _TARGET_TOLERANCE_RAW:
+                    # a sample from before the desk started moving
+                    return
+                else:
+                    stopped.set()
+                notified = True
+
+            await self._add_height_listener(on_height)
+            # only movement after the first reference input counts
+            moved = False
+            try:
+                while self._moving:
+                    stopped.clear()
+                    notified = False
+                    self._height_cache = None
+                    await self._client.write_gatt_char(self._chr_reference_input, data)
+
+                    # The reference input has to be repeated every 200 ms
+                    try:
+                        await asyncio.wait_for(stopped.wait(), 0.2)
+                    except asyncio.TimeoutError:
+                        pass
+                    else:
+                        break
+
+                    # Without any notifications the desk may not be moving,
+                    # fall back to reading the speed.
+                    # Stop as soon as the speed is 0,
+                    # which means the desk has reached the target position
+                    if not notified and await self.get_speed() == 0:
+                        break
+            finally:
+                if on_height in self._height_listeners:
+                    self._height_listeners.remove(on_height)
+
+        async with self._move_lock:
+            self._moving = True
+            try:
+                self._move_started = False
+                self._move_task = asyncio.create_task(do_move())
+                try:
+                    await asyncio.wait_for(self._move_task, self.MOVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    # the move task sent the stop commands when it was cancelled
+                    self._logger.error(
+                        "Failed to reach target within %.1f seconds", self.MOVE_TIMEOUT
+                    )
+                except asyncio.CancelledError:
+                    # stop() cancels the move, anything else cancelled us
+                    if self._moving:
+                        raise
+            finally:
+                self._moving = False
 
     async def stop(self):
         """Stop desk movement."""
         self._moving = False
-        if self._move_task:
+
+        # Cancel the move right away instead of waiting for the current
+        # iteration of the move loop to finish.
+        if self._move_task is not None and not self._move_task.done():
             self._logger.debug("Desk was moving, waiting for it to stop")
-            await self._move_task
+            self._move_task.cancel()
+            await asyncio.gather(self._move_task, return_exceptions=True)
+            # a move cancelled before it started has not sent the stop commands
+            if self._move_started:
+                return
 
         await self._stop()
 
     async def _stop(self):
         """Send stop commands"""
         self._logger.debug("Sending stop commands")
-        await asyncio.gather(
-            self._client.write_gatt_char(_UUID_COMMAND, _COMMAND_STOP, response=False),
-            self._client.write_gatt_char(
-                _UUID_REFERENCE_INPUT, _COMMAND_REFERENCE_INPUT_STOP, response=False
-            ),
-        )
+        self._height_cache = None
+        write = self._client.write_gatt_char
+
+        async def send() -> None:
+            async with self._command_lock():
+                await write(self._chr_command, _COMMAND_STOP, response=False)
+            await write(
+                self._chr_reference_input, _COMMAND_REFERENCE_INPUT_STOP, response=False
+            )
+
+        # the desk must stop even if the caller is cancelled
+        await asyncio.shield(send())
 
     async def get_height(self) -> float:
         """
@@ -440,8 +679,14 @@ class IdasenDesk:
         >>> asyncio.run(example())
         (1.0, 0.0)
         """
-        raw = await self._client.read_gatt_char(_UUID_HEIGHT)
-        return _bytes_to_meters_and_speed(raw)
+        cache = self._height_cache
+        if cache is not None and time.monotonic() - cache[0] < _HEIGHT_CACHE_TTL:
+            return cache[1], cache[2]
+
+        raw = await self._client.read_gatt_char(self._chr_height)
+        height, speed = _bytes_to_meters_and_speed(raw)
+        self._height_cache = (time.monotonic(), height, speed)
+        return height, speed
 
     @staticmethod
     async def discover() -> Optional[str]:
@@ -455,7 +700,11 @@ class IdasenDesk:
         'AA:AA:AA:AA:AA:AA'
         """
         try:
-            device = await BleakScanner.find_device_by_filter(_is_desk)
+            # let the OS filter advertisements, _is_desk is kept for
+            # backends that ignore the filter
+            device = await BleakScanner.find_device_by_filter(
+                _is_desk, service_uuids=[_UUID_ADV_SVC]
+            )
         except Exception:
             return None
 
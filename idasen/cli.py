@@ -1,61 +1,214 @@
-import functools
-
 from . import IdasenDesk
+from types import MappingProxyType
 from typing import Any
 from typing import Callable
-from typing import Dict
 from typing import List
+from typing import Mapping
 from typing import Optional
 import argparse
 import asyncio
-import importlib.metadata
+import hashlib
+import json
 import logging
 import os
+import re
+import shutil
 import sys
-import voluptuous as vol
-import yaml
-import platform
 
 HOME = os.path.expanduser("~")
 IDASEN_CONFIG_DIRECTORY = os.path.join(HOME, ".config", "idasen")
 IDASEN_CONFIG_PATH = os.path.join(IDASEN_CONFIG_DIRECTORY, "idasen.yaml")
 
-DEFAULT_CONFIG: Dict[str, Any] = {
-    "positions": {"stand": 1.1, "sit": 0.75},
-    "mac_address": "AA:AA:AA:AA:AA:AA",
-}
-
-CONFIG_SCHEMA = vol.Schema(
+# read-only, copy it to make a config
+DEFAULT_CONFIG: Mapping[str, Any] = MappingProxyType(
     {
-        "mac_address": vol.All(str, vol.Length(min=17, max=36)),
-        "positions": {
-            str: vol.All(
-                vol.Any(float, int),
-                vol.Range(min=IdasenDesk.MIN_HEIGHT, max=IdasenDesk.MAX_HEIGHT),
-            )
-        },
-    },
-    extra=False,
+        "positions": MappingProxyType({"stand": 1.1, "sit": 0.75}),
+        "mac_address": "AA:AA:AA:AA:AA:AA",
+    }
+)
+
+CONFIG_KEYS = {"mac_address", "positions"}
+
+# a MAC address, or the UUID bleak uses in its place on macOS
+MAC_ADDRESS_RE = re.compile(
+    r"(?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2}"
+    r"|[0-9A-Fa-f]{8}-(?:[0-9A-Fa-f]{4}-){3}[0-9A-Fa-f]{12}"
+)
+
+# written by init, the same as dumping DEFAULT_CONFIG without the YAML emitter
+INIT_TEMPLATE = (
+    "# https://newam.github.io/idasen/index.html#configuration\n"
+    "mac_address: '{mac_address}'\n"
+    "positions:\n"
+    "  sit: {sit}\n"
+    "  stand: {stand}\n"
 )
 
 RESERVED_NAMES = {"init", "pair", "monitor", "height", "speed", "save", "delete"}
 
 
+def validate_config(config: dict) -> dict:
+    """
+    Validate the user config.
+
+    Raises:
+        ValueError: The config is invalid.
+    """
+    if not isinstance(config, dict):
+        raise ValueError("expected a dictionary")
+
+    for key in config:
+        if key not in CONFIG_KEYS:
+            raise ValueError(f"extra keys not allowed @ data[{key!r}]")
+
+    if "mac_address" in config:
+        mac_address = config["mac_address"]
+        if not isinstance(mac_address, str):
+            raise ValueError("expected str for dictionary value @ data['mac_address']")
+        if MAC_ADDRESS_RE.fullmatch(mac_address) is None:
+            raise ValueError("expected a MAC address or UUID @ data['mac_address']")
+
+    positions = config.get("positions", {})
+    if not isinstance(positions, dict):
+        raise ValueError(
+            "expected a dictionary for dictionary value @ data['positions']"
+        )
+
+    for name, value in positions.items():
+        if not isinstance(name, str):
+            raise ValueError(f"extra keys not allowed @ data['positions'][{name!r}]")
+        if name in RESERVED_NAMES:
+            raise ValueError(f"position with name '{name}' is a reserved name.")
+        if isinstance(value, bool) or not isinstance(value, (float, int)):
+            raise ValueError(f"expected a number @ data['positions'][{name!r}]")
+        if not IdasenDesk.MIN_HEIGHT <= value <= IdasenDesk.MAX_HEIGHT:
+            raise ValueError(
+                f"value must be between {IdasenDesk.MIN_HEIGHT} and "
+                f"{IdasenDesk.MAX_HEIGHT} @ data['positions'][{name!r}]"
+            )
+
+    return config
+
+
+def _write_file(path: str, content: str):
+    """Replace the file at ``path``, it is never seen partially written."""
+    # write through symbolic links, e.g. to a config kept with other dotfiles
+    path = os.path.realpath(path)
+    tmp_path = path + ".tmp"
+    try:
+        f = open(tmp_path, "w")
+    except PermissionError:
+        # the directory is not writable, the file itself may still be
+        with open(path, "w") as f:
+            f.write(content)
+        return
+
+    try:
+        with f:
+            f.write(content)
+        # keep the permissions of the file being replaced, e.g. 0600
+        if os.path.exists(path):
+            shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _read_config_cache(path: str) -> dict:
+    """Read the parsed config cached for the config file at ``path``."""
+    try:
+        with open(path + ".cache", "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(cache, dict) or not isinstance(cache.get("config"), dict):
+        return {}
+
+    return cache
+
+
+def _write_config_cache(path: str, key: List[int], digest: str, config: dict):
+    """Cache the parsed config for the config file at ``path``."""
+    try:
+        _write_file(
+            path + ".cache",
+            json.dumps(
+                {
+                    "key": key,
+                    "digest": digest,
+                    "config": config,
+                }
+            ),
+        )
+    except OSError:
+        # the cache is an optimization, the config can still be used
+        pass
+
+
 def save_config(config: dict, path: str = IDASEN_CONFIG_PATH):
-    with open(path, "w") as f:
-        yaml.dump(config, f)
+    import yaml
+
+    _write_file(
+        path, yaml.dump(config, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper))
+    )
+
+    try:
+        os.remove(path + ".cache")
+    except FileNotFoundError:
+        pass
+
+
+def _validate_or_exit(config: dict) -> dict:
+    """Validate the user config, exit if it is invalid."""
+    try:
+        return validate_config(config)
+    except ValueError as e:
+        print(f"Invalid configuration: {e}", file=sys.stderr)
+        sys.exit(1)
 
 
 def load_config(path: str = IDASEN_CONFIG_PATH) -> dict:
     """Load user config."""
     try:
-        with open(path, "r") as f:
-            config = yaml.load(f, Loader=yaml.FullLoader)
+        stat = os.stat(path)
     except FileNotFoundError:
         return {}
 
+    # skip parsing if the file has not changed since last time
+    key = [stat.st_mtime_ns, stat.st_size]
+    cache = _read_config_cache(path)
+    if cache.get("key") == key:
+        return _validate_or_exit(cache["config"])
+
+    # the file is small, read it without the buffered IO layer
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return {}
+    try:
+        data = b""
+        while chunk := os.read(fd, stat.st_size + 1):
+            data += chunk
+    finally:
+        os.close(fd)
+
+    # the content is unchanged if the file was only touched or rewritten
+    digest = hashlib.sha256(data).hexdigest()
+    if cache.get("digest") == digest:
+        _write_config_cache(path, key, digest, cache["config"])
+        return _validate_or_exit(cache["config"])
+
+    # imported lazily, yaml is slow to import and only needed for the config
+    import yaml
+
+    # use libyaml when available
+    config = yaml.load(data, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
     # convert old config file format
-    if "positions" not in config:
+    migrated = "positions" not in config
+    if migrated:
         config["positions"] = dict()
         config["positions"]["sit"] = config.pop(
             "sit_height", DEFAULT_CONFIG["positions"]["sit"]
@@ -66,22 +219,12 @@ def load_config(path: str = IDASEN_CONFIG_PATH) -> dict:
 
         save_config(config, path)
 
-    try:
-        config = CONFIG_SCHEMA(config)
-    except vol.Invalid as e:
-        print(f"Invalid configuration: {e}", file=sys.stderr)
-        sys.exit(1)
-    else:
-        for position in config["positions"]:
-            if position in RESERVED_NAMES:
-                print(
-                    "Invalid configuration, "
-                    f"position with name '{position}' is a reserved name.",
-                    file=sys.stderr,
-                )
-                sys.exit(1)
+    config = _validate_or_exit(config)
 
-        return config
+    # the migrated file has new content, it is cached when it is next loaded
+    if not migrated:
+        _write_config_cache(path, key, digest, config)
+    return config
 
 
 def add_common_args(parser: argparse.ArgumentParser):
@@ -99,40 +242,93 @@ def add_common_args(parser: argparse.ArgumentParser):
     )
 
 
-def get_parser(config: dict) -> argparse.ArgumentParser:
-    parser = argparse.ArgumentParser(description="ikea IDÅSEN desk control")
-    add_common_args(parser)
-    sub = parser.add_subparsers(dest="sub", help="Subcommands", required=False)
+def requested_subcommand(argv: List[str]) -> Optional[str]:
+    """
+    Find the subcommand in ``argv`` without parsing it.
+
+    Returns ``None`` if help is requested before the subcommand, the top
+    level help lists every subcommand.
+    """
+    args = iter(argv)
+    for arg in args:
+        if arg in ("-h", "--help"):
+            return None
+        elif arg == "--mac-address":
+            # skip the option value
+            next(args, None)
+        elif not arg.startswith("-"):
+            return arg
+
+    return None
+
 
-    height_parser = sub.add_parser("height", help="Get the desk height.")
-    speed_parser = sub.add_parser("speed", help="Get the desk speed.")
-    monitor_parser = sub.add_parser("monitor", help="Monitor the desk position.")
-    init_parser = sub.add_parser("init", help="Initialize a new configuration file.")
-    save_parser = sub.add_parser("save", help="Save current desk position.")
-    pair_parser = sub.add_parser("pair", help="Pair with device.")
-    save_parser.add_argument("name", help="Position name")
-    delete_parser = sub.add_parser("delete", help="Remove position with given name.")
-    delete_parser.add_argument("name", help="Position name")
+def get_parser(
+    config: Mapping[str, Any], argv: Optional[List[str]] = None
+) -> argparse.ArgumentParser:
+    """
+    Create the command line parser.
+
+    If ``argv`` names a known subcommand only that subparser is built,
+    otherwise all of them are built, e.g. for the top level help.
+    """
+    # the common arguments are built once and shared by all parsers
+    common = argparse.ArgumentParser(add_help=False)
+    add_common_args(common)
+
+    parser = argparse.ArgumentParser(
+        description="ikea IDÅSEN desk control", parents=[common]
+    )
+    sub = parser.add_subparsers(dest="sub", help="Subcommands", required=False)
 
     positions = config.get("positions", {})
+
+    requested = None if argv is None else requested_subcommand(argv)
+    if requested not in RESERVED_NAMES and requested not in positions:
+        requested = None
+
+    def wanted(name: str) -> bool:
+        return requested is None or requested == name
+
+    if wanted("height"):
+        sub.add_parser("height", parents=[common], help="Get the desk height.")
+    if wanted("speed"):
+        sub.add_parser("speed", parents=[common], help="Get the desk speed.")
+    if wanted("monitor"):
+        sub.add_parser("monitor", parents=[common], help="Monitor the desk position.")
+    if wanted("init"):
+        init_parser = sub.add_parser(
+            "init", parents=[common], help="Initialize a new configuration file."
+        )
+        init_parser.add_argument(
+            "-f",
+            "--force",
+            action="store_true",
+            help="Overwrite any existing configuration files.",
+        )
+    if wanted("save"):
+        save_parser = sub.add_parser(
+            "save", parents=[common], help="Save current desk position."
+        )
+        save_parser.add_argument("name", help="Position name")
+    if wanted("pair"):
+        sub.add_parser("pair", parents=[common], help="Pair with device.")
+    if wanted("delete"):
+        delete_parser = sub.add_parser(
+            "delete", parents=[common], help="Remove position with given name."
+        )
+        delete_parser.add_argument("name", help="Position name")
+
     for name, value in positions.items():
-        subcommand = sub.add_parser(name, help=f"Move the desk to {value}m.")
-        add_common_args(subcommand)
-
-    init_parser.add_argument(
-        "-f",
-        "--force",
-        action="store_true",
-        help="Overwrite any existing configuration files.",
-    )
+        if wanted(name):
+            sub.add_parser(name, parents=[common], help=f"Move the desk to {value}m.")
 
-    add_common_args(init_parser)
-    add_common_args(pair_parser)
-    add_common_args(height_parser)
-    add_common_args(speed_parser)
-    add_common_args(monitor_parser)
-    add_common_args(save_parser)
-    add_common_args(delete_parser)
+    # usage in error messages lists every subcommand, even those not built
+    if requested is not None:
+        names = dict.fromkeys(
+            ["height", "speed", "monitor", "init", "save", "pair", "delete"]
+        )
+        names.update(dict.fromkeys(positions))
+        sub.metavar = "{" + ",".join(names) + "}"
 
     return parser
 
@@ -143,16 +339,20 @@ async def init(args: argparse.Namespace) -> int:
         print("Use --force to overwrite existing configuration.", file=sys.stderr)
         return 1
     else:
+        mac_address = DEFAULT_CONFIG["mac_address"]
         mac = await IdasenDesk.discover()
         if mac is not None:
             print(f"Discovered desk's MAC address: {mac}", file=sys.stderr)
-            DEFAULT_CONFIG["mac_address"] = str(mac)
+            mac_address = str(mac)
         else:
             print("Failed to discover desk's MAC address", file=sys.stderr)
         os.makedirs(IDASEN_CONFIG_DIRECTORY, exist_ok=True)
-        with open(IDASEN_CONFIG_PATH, "w") as f:
-            f.write("# https://newam.github.io/idasen/index.html#configuration\n")
-            yaml.dump(DEFAULT_CONFIG, f)
+        _write_file(
+            IDASEN_CONFIG_PATH,
+            INIT_TEMPLATE.format(
+                mac_address=mac_address, **DEFAULT_CONFIG["positions"]
+            ),
+        )
         print(
             f"Created new configuration file at: {IDASEN_CONFIG_PATH}", file=sys.stderr
         )
@@ -166,6 +366,8 @@ async def pair(args: argparse.Namespace) -> Optional[int]:
         async with IdasenDesk(args.mac_address, exit_on_fail=True) as desk:
             await desk.pair()
     except NotImplementedError as e:
+        import platform
+
         if platform.system() == "Darwin":
             print(
                 "The pair subcommand does not function reliably on macOS.\n"
@@ -246,51 +448,87 @@ def from_config(
     key: str,
     raise_error: bool = True,
 ):
-    if hasattr(args, key) and getattr(args, key) is None:
+    values = vars(args)
+    if key in values and values[key] is None:
         if key in config:
-            setattr(args, key, config[key])
+            values[key] = config[key]
         elif raise_error:
             parser.error(f"{key} must be provided via the CLI or the config file")
 
 
+_LEVELS = (
+    logging.CRITICAL,
+    logging.ERROR,
+    logging.WARNING,
+    logging.INFO,
+    logging.DEBUG,
+)
+
+
 def count_to_level(count: int) -> int:
-    if count == 1:
-        return logging.ERROR
-    elif count == 2:
-        return logging.WARNING
-    elif count == 3:
-        return logging.INFO
-    elif count >= 4:
-        return logging.DEBUG
+    return _LEVELS[min(count, len(_LEVELS) - 1)]
 
-    return logging.CRITICAL
+
+SUBCOMMANDS: Mapping[str, Callable] = MappingProxyType(
+    {
+        "init": init,
+        "pair": pair,
+        "monitor": monitor,
+        "height": height,
+        "speed": speed,
+    }
+)
+
+# subcommands that also take the config
+CONFIG_SUBCOMMANDS: Mapping[str, Callable] = MappingProxyType(
+    {
+        "save": save,
+        "delete": delete,
+    }
+)
 
 
 def subcommand_to_callable(sub: str, config: dict) -> Callable:
-    if sub == "init":
-        return init
-    elif sub == "pair":
-        return pair
-    elif sub == "monitor":
-        return monitor
-    elif sub == "height":
-        return height
-    elif sub == "speed":
-        return speed
-    elif sub == "save":
-        return functools.partial(save, config=config)
-    elif sub == "delete":
-        return functools.partial(delete, config=config)
-    elif sub in config.get("positions", {}):
-        position = config["positions"][sub]
-        return functools.partial(move_to, position=position)
-    else:
-        raise AssertionError(f"internal error, please report this bug {sub=}")
+    if sub in SUBCOMMANDS:
+        return SUBCOMMANDS[sub]
+
+    if sub in CONFIG_SUBCOMMANDS:
+        func = CONFIG_SUBCOMMANDS[sub]
+
+        async def with_config(args: argparse.Namespace) -> int:
+            return await func(args, config)
+
+        return with_config
+
+    positions = config.get("positions", {})
+    if sub in positions:
+        position = positions[sub]
+
+        async def move_to_position(args: argparse.Namespace) -> None:
+            await move_to(args, position)
+
+        return move_to_position
+
+    raise AssertionError(f"internal error, please report this bug {sub=}")
+
+
+def print_version():
+    import importlib.metadata
+
+    print(importlib.metadata.version("idasen"))
+    sys.exit(0)
 
 
 def main(argv: Optional[List[str]] = None):
-    config = load_config()
-    parser = get_parser(config)
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # the version does not need the config or parser
+    if "--version" in argv:
+        print_version()
+
+    config = load_config(IDASEN_CONFIG_PATH)
+    parser = get_parser(config, argv)
     args = parser.parse_args(argv)
 
     from_config(args, config, parser, "mac_address", raise_error=args.sub != "init")
@@ -307,9 +545,7 @@ def main(argv: Optional[List[str]] = None):
     root_logger.setLevel(level)
 
     if args.version:
-        version = importlib.metadata.version("idasen")
-        print(version)
-        sys.exit(0)
+        print_version()
     elif args.sub is None:
         print("A subcommand is required")
         parser.print_usage()
@@ -6,27 +6,79 @@ from idasen.cli import from_config
 from idasen.cli import get_parser
 from idasen.cli import init
 from idasen.cli import pair
+from idasen.cli import requested_subcommand
 from idasen.cli import load_config
 from idasen.cli import main
 from idasen.cli import subcommand_to_callable
+from idasen.cli import validate_config
+from pathlib import Path
 from types import SimpleNamespace
 from typing import Any
 from typing import Dict
+from typing import List
 from typing import Optional
 from unittest import mock
 import argparse
+import hashlib
+import importlib.metadata
 import logging
 import os
 import pytest
+import shutil
 import sys
 import yaml
 import platform
 
+DATA_DIR = Path(__file__).parent / "data"
+
 
 def test_get_parser_smoke():
     assert isinstance(get_parser(DEFAULT_CONFIG), argparse.ArgumentParser)
 
 
+@pytest.mark.parametrize(
+    "argv, sub",
+    [
+        ([], None),
+        (["-h"], None),
+        (["sit"], "sit"),
+        (["-h", "sit"], None),
+        (["sit", "--help"], "sit"),
+        (["-vv", "save", "desk"], "save"),
+        (["--mac-address", "AA:AA:AA:AA:AA:AA", "height"], "height"),
+        (["--mac-address=AA:AA:AA:AA:AA:AA", "height"], "height"),
+    ],
+)
+def test_requested_subcommand(argv: List[str], sub: Optional[str]):
+    assert requested_subcommand(argv) == sub
+
+
+def test_get_parser_requested_subcommand():
+    parser = get_parser(DEFAULT_CONFIG, ["init", "--force"])
+    assert parser.parse_args(["init", "--force"]).force is True
+
+    # unknown subcommands are reported with all of the choices
+    parser = get_parser(DEFAULT_CONFIG, ["not_a_real_sub_command"])
+    assert "stand" in parser.format_help()
+    with pytest.raises(SystemExit):
+        parser.parse_args(["not_a_real_sub_command"])
+
+
+@pytest.mark.parametrize("argv", [["-h", "sit"], ["--help", "height"]])
+def test_get_parser_help_before_subcommand(argv: List[str]):
+    help_text = get_parser(DEFAULT_CONFIG, argv).format_help()
+    for name in [*cli.RESERVED_NAMES, *DEFAULT_CONFIG["positions"]]:
+        assert name in help_text
+
+
+def test_get_parser_requested_usage():
+    # errors show the same usage as when every subparser is built
+    assert (
+        get_parser(DEFAULT_CONFIG, ["sit", "bogus"]).format_usage()
+        == get_parser(DEFAULT_CONFIG).format_usage()
+    )
+
+
 def test_load_config_no_file():
     assert load_config("not_a_real_file_path") == {}
 
@@ -40,7 +92,99 @@ def test_load_config_invalid_schema(tmpdir: str):
         load_config(file_path)
 
 
+def test_load_config_valid(tmpdir: str):
+    # copied, load_config writes its cache next to the file
+    file_path = shutil.copy(DATA_DIR / "config_valid.yaml", tmpdir)
+    assert load_config(file_path) == {
+        "mac_address": "AA:AA:AA:AA:AA:AA",
+        "positions": {"sit": 0.90},
+    }
+
+
 def test_load_config_reserved_position(tmpdir: str):
+    file_path = shutil.copy(DATA_DIR / "config_reserved.yaml", tmpdir)
+    with pytest.raises(SystemExit):
+        load_config(file_path)
+
+
+def test_save_config_symlink(tmpdir: str):
+    target_path = os.path.join(tmpdir, "dotfiles.yaml")
+    file_path = os.path.join(tmpdir, "config.yaml")
+    with open(target_path, "w") as f:
+        f.write("positions: {}\n")
+    os.symlink(target_path, file_path)
+
+    config = {"mac_address": "AA:AA:AA:AA:AA:AA", "positions": {"sit": 0.9}}
+    cli.save_config(config, file_path)
+
+    assert os.path.islink(file_path)
+    assert load_config(file_path) == config
+    assert not os.path.exists(target_path + ".tmp")
+
+
+def test_save_config_mode(tmpdir: str):
+    file_path = os.path.join(tmpdir, "config.yaml")
+    with open(file_path, "w") as f:
+        f.write("positions: {}\n")
+    os.chmod(file_path, 0o600)
+
+    cli.save_config({"positions": {"sit": 0.9}}, file_path)
+    assert os.stat(file_path).st_mode & 0o777 == 0o600
+
+
+def test_save_config_write_fails(tmpdir: str, monkeypatch: pytest.MonkeyPatch):
+    file_path = os.path.join(tmpdir, "config.yaml")
+
+    def replace(src: str, dst: str):
+        raise OSError
+
+    monkeypatch.setattr(os, "replace", replace)
+    with pytest.raises(OSError):
+        cli.save_config({"positions": {"sit": 0.9}}, file_path)
+    assert os.listdir(tmpdir) == []
+
+
+@pytest.mark.parametrize(
+    "config",
+    [
+        [],
+        {"extra_key": 456},
+        {"mac_address": 1234},
+        {"mac_address": "AA:AA"},
+        {"mac_address": "AA:AA:AA:AA:AA:AA:AA:AA:AA"},
+        {"mac_address": "not a mac address"},
+        {"positions": [0.9]},
+        {"positions": {1: 0.9}},
+        {"positions": {"sit": "low"}},
+        {"positions": {"sit": True}},
+        {"positions": {"init": 0.9}},
+        {"positions": {"sit": 0.1}},
+        {"positions": {"stand": 2}},
+    ],
+)
+def test_validate_config_invalid(config: Any):
+    with pytest.raises(ValueError):
+        validate_config(config)
+
+
+@pytest.mark.parametrize(
+    "mac_address",
+    ["AA:AA:AA:AA:AA:AA", "12:34:56:ab:cd:ef", "C2B0C6D4-ECA1-4F4B-8D8A-0A1B2C3D4E5F"],
+)
+def test_validate_config_mac_address(mac_address: str):
+    config = {"mac_address": mac_address}
+    assert validate_config(config) == config
+
+
+def test_validate_config():
+    config = {
+        "mac_address": DEFAULT_CONFIG["mac_address"],
+        "positions": dict(DEFAULT_CONFIG["positions"]),
+    }
+    assert validate_config(config) == DEFAULT_CONFIG
+
+
+def test_load_config_cached(tmpdir: str):
     file_path = os.path.join(tmpdir, "config.yaml")
     config: Dict[str, Any] = {
         "mac_address": "AA:AA:AA:AA:AA:AA",
@@ -51,14 +195,59 @@ def test_load_config_reserved_position(tmpdir: str):
         yaml.dump(config, f)
 
     assert load_config(file_path) == config
+    assert os.path.isfile(file_path + ".cache")
+
+    # the cached config is used as long as the file is unchanged
+    with mock.patch.object(yaml, "load") as load_mock:
+        assert load_config(file_path) == config
+        load_mock.assert_not_called()
+
+        # the content is compared if the file was touched
+        os.utime(file_path, ns=(0, 0))
+        assert load_config(file_path) == config
+        load_mock.assert_not_called()
+
+    # saving the config invalidates the cache
+    config["positions"]["stand"] = 1.1
+    cli.save_config(config, file_path)
+    assert not os.path.isfile(file_path + ".cache")
+    assert load_config(file_path) == config
 
-    config["positions"]["init"] = 0.90
+
+def test_load_config_cache_validated(tmpdir: str, monkeypatch):
+    file_path = os.path.join(tmpdir, "config.yaml")
+    config: Dict[str, Any] = {
+        "mac_address": "AA:AA:AA:AA:AA:AA",
+        "positions": {"sit": 0.90},
+    }
 
     with open(file_path, "w") as f:
         yaml.dump(config, f)
 
-    with pytest.raises(SystemExit):
-        load_config(file_path)
+    assert load_config(file_path) == config
+
+    # the cached config is validated against the current rules
+    monkeypatch.setattr(cli, "RESERVED_NAMES", cli.RESERVED_NAMES | {"sit"})
+    with mock.patch.object(yaml, "load") as load_mock:
+        with pytest.raises(SystemExit):
+            load_config(file_path)
+        load_mock.assert_not_called()
+
+
+def test_load_config_migrated_cache(tmpdir: str):
+    file_path = os.path.join(tmpdir, "config.yaml")
+    with open(file_path, "w") as f:
+        yaml.dump({"mac_address": "AA:AA:AA:AA:AA:AA", "sit_height": 0.9}, f)
+
+    config = load_config(file_path)
+    assert config["positions"]["sit"] == 0.9
+    # the file was rewritten, the old content is not cached
+    assert not os.path.isfile(file_path + ".cache")
+
+    assert load_config(file_path) == config
+    with open(file_path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    assert cli._read_config_cache(file_path)["digest"] == digest
 
 
 async def test_init_exists_no_force():
@@ -67,56 +256,59 @@ async def test_init_exists_no_force():
 
 
 @pytest.mark.parametrize("discover_return", ["AA:AA:AA:AA:AA:AA", None])
-async def test_init(discover_return: Optional[str]):
-    with (
-        mock.patch.object(os.path, "isfile", return_value=True),
-        mock.patch.object(yaml, "dump") as dump_mock,
-        mock.patch.object(
-            IdasenDesk,
-            "discover",
-            return_value=discover_return,
-        ),
-        mock.patch.object(os, "makedirs"),
-        mock.patch("builtins.open"),
+async def test_init(discover_return: Optional[str], tmpdir: str, monkeypatch):
+    file_path = os.path.join(tmpdir, "idasen.yaml")
+    monkeypatch.setattr(cli, "IDASEN_CONFIG_DIRECTORY", str(tmpdir))
+    monkeypatch.setattr(cli, "IDASEN_CONFIG_PATH", file_path)
+
+    with mock.patch.object(
+        IdasenDesk,
+        "discover",
+        return_value=discover_return,
     ):
         assert await init(args=argparse.Namespace(force=True)) == 0
-        dump_mock.assert_called_once()
 
+    with open(file_path, "r") as f:
+        config = yaml.safe_load(f)
 
-async def test_pair():
-    with (
-        mock.patch.object(IdasenDesk, "disconnect", side_effect=None),
-        mock.patch.object(IdasenDesk, "connect", side_effect=None),
-        mock.patch.object(IdasenDesk, "pair", side_effect=None),
-        mock.patch.object(IdasenDesk, "__init__", return_value=None),
-    ):
-        assert await pair(args=argparse.Namespace(mac_address="a")) is None
+    assert config["mac_address"] == (discover_return or DEFAULT_CONFIG["mac_address"])
+    assert config["positions"] == DEFAULT_CONFIG["positions"]
 
 
-async def test_pair_darwin():
-    with (
-        mock.patch.object(IdasenDesk, "disconnect", side_effect=None),
-        mock.patch.object(IdasenDesk, "connect", side_effect=None),
-        mock.patch.object(IdasenDesk, "pair", side_effect=NotImplementedError),
-        mock.patch.object(platform, "system", return_value="Darwin"),
-        mock.patch.object(IdasenDesk, "__init__", return_value=None),
-    ):
-        assert await pair(args=argparse.Namespace(mac_address="a")) == 1
+@pytest.fixture
+def desk_pair(monkeypatch: pytest.MonkeyPatch) -> mock.AsyncMock:
+    """Patch out the desk connection, returns the mocked ``pair`` method."""
+    monkeypatch.setattr(IdasenDesk, "__init__", mock.Mock(return_value=None))
+    monkeypatch.setattr(IdasenDesk, "connect", mock.AsyncMock())
+    monkeypatch.setattr(IdasenDesk, "disconnect", mock.AsyncMock())
+    pair_mock = mock.AsyncMock()
+    monkeypatch.setattr(IdasenDesk, "pair", pair_mock)
+    return pair_mock
 
 
-async def test_pair_not_darwin():
-    with (
-        mock.patch.object(IdasenDesk, "disconnect", side_effect=None),
-        mock.patch.object(IdasenDesk, "connect", side_effect=None),
-        mock.patch.object(IdasenDesk, "pair", side_effect=NotImplementedError),
-        mock.patch.object(platform, "system", return_value="NotDarwin"),
-        mock.patch.object(IdasenDesk, "__init__", return_value=None),
-        pytest.raises(NotImplementedError),
-    ):
+async def test_pair(desk_pair: mock.AsyncMock):
+    assert await pair(args=argparse.Namespace(mac_address="a")) is None
+    desk_pair.assert_awaited_once()
+
+
+async def test_pair_darwin(desk_pair: mock.AsyncMock, monkeypatch: pytest.MonkeyPatch):
+    desk_pair.side_effect = NotImplementedError
+    monkeypatch.setattr(platform, "system", lambda: "Darwin")
+    assert await pair(args=argparse.Namespace(mac_address="a")) == 1
+
+
+async def test_pair_not_darwin(
+    desk_pair: mock.AsyncMock, monkeypatch: pytest.MonkeyPatch
+):
+    desk_pair.side_effect = NotImplementedError
+    monkeypatch.setattr(platform, "system", lambda: "NotDarwin")
+    with pytest.raises(NotImplementedError):
         await pair(args=argparse.Namespace(mac_address="a"))
 
 
 class Parser:
+    __slots__ = ("error_called",)
+
     def __init__(self):
         self.error_called = False
 
@@ -167,53 +359,67 @@ def test_count_to_level(count: int, level: int):
     assert count_to_level(count) == level
 
 
-seen_it = []
-
-
-@pytest.mark.parametrize(
-    "sub",
-    ["init", "pair", "monitor", "sit", "height", "speed", "stand", "save", "delete"],
-)
-def test_subcommand_to_callable(sub: str):
-    global seen_it
-
-    func = subcommand_to_callable(sub, DEFAULT_CONFIG)
-    assert callable(func)
-    assert func not in seen_it
-    seen_it.append(func)
-
-
-def test_main_to_exit():
+def test_subcommand_to_callable():
+    config = dict(DEFAULT_CONFIG)
+    funcs = [
+        subcommand_to_callable(sub, config)
+        for sub in [
+            "init",
+            "pair",
+            "monitor",
+            "sit",
+            "height",
+            "speed",
+            "stand",
+            "save",
+            "delete",
+        ]
+    ]
+    assert all(callable(func) for func in funcs)
+    assert len(set(funcs)) == len(funcs)
+
+
+@pytest.fixture
+def exit_calls(monkeypatch: pytest.MonkeyPatch) -> List[Any]:
+    """Record calls to ``sys.exit`` instead of exiting."""
+    calls: List[Any] = []
+    monkeypatch.setattr(sys, "exit", calls.append)
+    return calls
+
+
+@pytest.fixture
+def config_path(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> str:
+    """Keep main from loading, and caching, the user's real config."""
+    path = str(tmp_path / "idasen.yaml")
+    monkeypatch.setattr(cli, "IDASEN_CONFIG_PATH", path)
+    return path
+
+
+def patch_parse_args(monkeypatch: pytest.MonkeyPatch, args: SimpleNamespace):
+    monkeypatch.setattr(argparse.ArgumentParser, "parse_args", lambda *_: args)
+
+
+def test_main_to_exit(
+    monkeypatch: pytest.MonkeyPatch, exit_calls: List[Any], config_path: str
+):
     mock_args = SimpleNamespace(sub="not_a_real_sub_command", version=False, verbose=0)
 
     async def do_nothing(args: argparse.Namespace):
         assert args == mock_args
 
-    with (
-        mock.patch.object(
-            argparse.ArgumentParser,
-            "parse_args",
-            return_value=mock_args,
-        ),
-        mock.patch.object(cli, "subcommand_to_callable", return_value=do_nothing),
-        mock.patch.object(sys, "exit") as sys_exit_mock,
-    ):
-        main()
-        sys_exit_mock.assert_called_once_with(0)
-
-
-def test_main_internal_error():
-    with (
-        mock.patch.object(
-            argparse.ArgumentParser,
-            "parse_args",
-            return_value=SimpleNamespace(
-                sub="not_a_real_sub_command", version=False, verbose=0
-            ),
-        ),
-        pytest.raises(AssertionError),
-    ):
-        main()
+    patch_parse_args(monkeypatch, mock_args)
+    monkeypatch.setattr(cli, "subcommand_to_callable", lambda *_: do_nothing)
+    main([])
+    assert exit_calls == [0]
+
+
+def test_main_internal_error(monkeypatch: pytest.MonkeyPatch, config_path: str):
+    patch_parse_args(
+        monkeypatch,
+        SimpleNamespace(sub="not_a_real_sub_command", version=False, verbose=0),
+    )
+    with pytest.raises(AssertionError):
+        main([])
 
 
 @pytest.mark.parametrize(
@@ -231,29 +437,38 @@ def test_main_internal_error():
         None,
     ],
 )
-def test_main_version(sub: Optional[str]):
-    with (
-        mock.patch.object(
-            argparse.ArgumentParser,
-            "parse_args",
-            return_value=SimpleNamespace(sub=sub, version=True, verbose=0, force=False),
-        ),
-        mock.patch.object(sys, "exit") as sys_exit_mock,
-    ):
-        main()
-        sys_exit_mock.assert_called_once_with(0)
-
-
-def test_main_no_sub():
-    with (
-        mock.patch.object(
-            argparse.ArgumentParser,
-            "parse_args",
-            return_value=SimpleNamespace(
-                sub=None, version=False, verbose=0, force=False
-            ),
-        ),
-        mock.patch.object(sys, "exit") as sys_exit_mock,
-    ):
-        main()
-        sys_exit_mock.assert_called_once_with(1)
+def test_main_version(
+    sub: Optional[str],
+    monkeypatch: pytest.MonkeyPatch,
+    exit_calls: List[Any],
+    config_path: str,
+):
+    patch_parse_args(
+        monkeypatch, SimpleNamespace(sub=sub, version=True, verbose=0, force=False)
+    )
+    main([])
+    assert exit_calls == [0]
+
+
+def test_main_version_short_circuit(
+    capsys: pytest.CaptureFixture, monkeypatch: pytest.MonkeyPatch
+):
+    def load_config():
+        raise AssertionError("the config should not be loaded")
+
+    monkeypatch.setattr(cli, "load_config", load_config)
+    with pytest.raises(SystemExit) as exc_info:
+        main(["sit", "--version"])
+
+    assert exc_info.value.code == 0
+    assert capsys.readouterr().out.strip() == importlib.metadata.version("idasen")
+
+
+def test_main_no_sub(
+    monkeypatch: pytest.MonkeyPatch, exit_calls: List[Any], config_path: str
+):
+    patch_parse_args(
+        monkeypatch, SimpleNamespace(sub=None, version=False, verbose=0, force=False)
+    )
+    main([])
+    assert exit_calls == [1]
@@ -14,16 +14,44 @@ import pytest
 # This will wear out your motors faster than normal usage.
 desk_mac: str = "AA:AA:AA:AA:AA:AA"
 
+# Bound once so the mock client does not look them up on every write.
+_UUID_COMMAND = idasen._UUID_COMMAND
+_UUID_REFERENCE_INPUT = idasen._UUID_REFERENCE_INPUT
+_COMMAND_UP = idasen._COMMAND_UP
+_COMMAND_DOWN = idasen._COMMAND_DOWN
+
+# Sent by MockBleakClient.start_notify, the callbacks only read them.
+_NOTIFY_INITIAL = b"\x00\x00\x00\x00"
+_NOTIFY_PAYLOADS = (
+    b"\x20\x0a\x00\x00",
+    b"\x20\x0a\x00\x00",
+    b"\x20\x0a\x20\x00",
+    b"\x20\x0a\x20\x00",
+    b"\x20\x2a\x00\x00",
+)
 
-class MockCharacteristic:
-    """Mocks a GATT Characteristic"""
+# (advertisement data, is_desk)
+_IS_DESK_CASES = (
+    (SimpleNamespace(service_uuids=()), False),
+    (SimpleNamespace(service_uuids=("foo",)), False),
+    (SimpleNamespace(service_uuids=("foo", idasen._UUID_ADV_SVC, "bar")), True),
+)
 
-    @property
-    def uuid(self):
-        return "99fa0020-338a-1024-8a49-009c0215f78a"
+# (raw, height, speed)
+_BYTES_TO_METERS_CASES = (
+    (b"\x64\x19\x00\x00", IdasenDesk.MAX_HEIGHT, 0),
+    (b"\x00\x00\x00\x00", IdasenDesk.MIN_HEIGHT, 0),
+    (b"\x51\x04\x00\x00", 0.7305, 0),
+    (b"\x08\x08\x00\x00", 0.8256, 0),
+    (b"\x08\x08\x02\x01", 0.8256, 0.0258),
+)
+
+
+class MockServiceCollection:
+    """Mocks a GATT service collection"""
 
     def get_characteristic(self, uuid):
-        return ""
+        return uuid
 
 
 class MockBleakClient:
@@ -51,32 +79,32 @@ class MockBleakClient:
         self.is_connected = False
 
     async def start_notify(self, uuid: str, callback: Callable):
-        await callback(uuid, bytearray([0x00, 0x00, 0x00, 0x00]))
-        await callback(None, bytearray([0x20, 0x0A, 0x00, 0x00]))
-        await callback(None, bytearray([0x20, 0x0A, 0x00, 0x00]))
-        await callback(None, bytearray([0x20, 0x0A, 0x20, 0x00]))
-        await callback(None, bytearray([0x20, 0x0A, 0x20, 0x00]))
-        await callback(None, bytearray([0x20, 0x2A, 0x00, 0x00]))
+        self._notify_callback = callback
+        await callback(uuid, _NOTIFY_INITIAL)
+        for payload in _NOTIFY_PAYLOADS:
+            await callback(None, payload)
+
+    async def notify(self, data: bytearray):
+        await self._notify_callback(None, data)
 
     async def write_gatt_char(self, uuid: str, data: bytearray, response: bool = False):
-        if uuid == idasen._UUID_COMMAND:
-            if data == idasen._COMMAND_UP:
+        if uuid == _UUID_COMMAND:
+            if data == _COMMAND_UP:
                 self._height += 0.001
-            elif data == idasen._COMMAND_DOWN:
+            elif data == _COMMAND_DOWN:
                 self._height -= 0.001
-        if uuid == idasen._UUID_REFERENCE_INPUT:
+        elif uuid == _UUID_REFERENCE_INPUT:
             assert len(data) == 2
 
-            data_with_speed = bytearray([data[0], data[1], 0, 0])
+            data_with_speed = bytearray(data) + b"\x00\x00"
             requested_height, _ = _bytes_to_meters_and_speed(data_with_speed)
-            self._height += min(0.1, max(-0.1, requested_height - self._height))
+            self._height += min(0.2, max(-0.2, requested_height - self._height))
 
             self._is_moving = self._height != requested_height
 
-    async def read_gatt_char(self, uuid: str) -> bytearray:
-        height_bytes = _meters_to_bytes(self._height)
-        speed_byte = 0x01 if self._is_moving else 0x00
-        return bytearray([height_bytes[0], height_bytes[1], 0x00, speed_byte])
+    async def read_gatt_char(self, uuid: str) -> bytes:
+        speed_bytes = b"\x00\x01" if self._is_moving else b"\x00\x00"
+        return _meters_to_bytes(self._height) + speed_bytes
 
     @property
     def address(self) -> str:
@@ -84,7 +112,7 @@ class MockBleakClient:
 
     @property
     def services(self):
-        return [MockCharacteristic()]
+        return MockServiceCollection()
 
 
 @pytest.fixture
@@ -107,6 +135,36 @@ def test_mac(desk: IdasenDesk):
     assert desk.mac == desk_mac
 
 
+async def test_patch_instance(desk: IdasenDesk):
+    # downstream users mock the desk by patching its methods
+    with mock.patch.object(desk, "get_height", return_value=0.9):
+        assert await desk.get_height() == 0.9
+
+
+def test_locks_created_in_loop():
+    # on python 3.9 a lock is bound to the loop that is current on creation,
+    # a desk built outside of the running loop must not create them yet
+    desk = IdasenDesk(mac=desk_mac)
+    client = MockBleakClient()
+    desk._client = client
+    write_gatt_char = client.write_gatt_char
+
+    async def slow_write(uuid, data, response=False):
+        await asyncio.sleep(0)
+        await write_gatt_char(uuid, data, response)
+
+    client.write_gatt_char = slow_write
+
+    async def move():
+        async with desk:
+            # contend for the command lock
+            await asyncio.gather(desk.move_up(), desk.move_down())
+            await desk.move_to_target(0.7)
+            return await desk.get_height()
+
+    assert abs(asyncio.run(move()) - 0.7) < 0.001
+
+
 async def test_pair(desk: IdasenDesk):
     if desk_mac != "AA:AA:AA:AA:AA:AA":
         return
@@ -145,32 +203,48 @@ async def test_get_height_and_speed(desk: IdasenDesk):
 
 
 async def test_monitor_height(desk: IdasenDesk):
-    mock_callback = mock.Mock()
+    heights = []
 
     async def monitor_callback(height: float):
-        mock_callback(height)
+        heights.append(height)
 
     await desk.monitor(monitor_callback)
-    mock_callback.assert_has_calls(
-        [mock.call(0.62), mock.call(0.8792), mock.call(1.6984)]
-    )
+    # let the callback task run
+    await asyncio.sleep(0)
+    assert heights == [0.62, 0.8792, 1.6984]
 
 
 async def test_monitor_speed_and_height(desk: IdasenDesk):
-    mock_callback = mock.Mock()
+    samples = []
 
     async def monitor_callback(height: float, speed: float):
-        mock_callback(height, speed)
+        samples.append((height, speed))
 
     await desk.monitor(monitor_callback)
-    mock_callback.assert_has_calls(
-        [
-            mock.call(0.62, 0.0),
-            mock.call(0.8792, 0.0),
-            mock.call(0.8792, 0.0032),
-            mock.call(1.6984, 0.0),
-        ]
-    )
+    # let the callback task run
+    await asyncio.sleep(0)
+    assert samples == [(0.62, 0.0), (0.8792, 0.0), (0.8792, 0.0032), (1.6984, 0.0)]
+
+
+async def test_monitor_slow_callback(desk: IdasenDesk):
+    heights = []
+    release = asyncio.Event()
+
+    async def monitor_callback(height: float):
+        await release.wait()
+        heights.append(height)
+
+    await desk.monitor(monitor_callback)
+    # the callback task takes the first sample and blocks
+    await asyncio.sleep(0)
+    for i in range(20):
+        await desk._client.notify(bytearray([0x00, i, 0x00, 0x00]))  # type: ignore
+
+    release.set()
+    await asyncio.sleep(0)
+    # the first sample was taken by the callback, then only the newest ones
+    assert len(heights) == 1 + idasen._MONITOR_QUEUE_SIZE
+    assert heights[-1] == _bytes_to_meters_and_speed(bytearray(b"\x00\x13\x00\x00"))[0]
 
 
 async def test_monitoraises(desk: IdasenDesk):
@@ -181,6 +255,23 @@ async def test_monitoraises(desk: IdasenDesk):
         await desk.monitor(monitor_callback)
 
 
+async def test_monitor_notify_fails(desk):
+    async def monitor_callback(height: float):
+        pass
+
+    desk._client.start_notify = mock.AsyncMock(side_effect=bleak.BleakError)
+
+    with pytest.raises(bleak.BleakError):
+        await desk.monitor(monitor_callback)
+
+    desk._client.start_notify.assert_awaited_once_with(
+        idasen._UUID_HEIGHT, desk._on_height_notify
+    )
+    assert not desk._notifying
+    assert not desk._height_listeners
+    assert not desk._monitor_tasks
+
+
 @pytest.mark.parametrize("target", [0.0, 2.0])
 async def test_move_to_target_raises(desk: IdasenDesk, target: float):
     with pytest.raises(ValueError):
@@ -193,6 +284,100 @@ async def test_move_to_target(desk: IdasenDesk, target: float):
     assert abs(await desk.get_height() - target) < 0.001
 
 
+async def test_move_to_target_already_moving(desk: IdasenDesk):
+    first = asyncio.create_task(desk.move_to_target(0.7))
+    # let the first move start
+    await asyncio.sleep(0)
+    assert desk.is_moving
+
+    # returns immediately without moving the desk
+    await desk.move_to_target(1.1)
+    assert not first.done()
+
+    await first
+    assert abs(await desk.get_height() - 0.7) < 0.001
+
+
+async def test_move_to_target_notifications():
+    desk = IdasenDesk(mac=desk_mac)
+    client = MockBleakClient()
+    desk._client = client
+    read_gatt_char = client.read_gatt_char
+    write_gatt_char = client.write_gatt_char
+    client.read_gatt_char = mock.AsyncMock(side_effect=read_gatt_char)
+
+    async def write_and_notify(uuid: str, data: bytearray, response: bool = False):
+        await write_gatt_char(uuid, data, response)
+        if uuid == idasen._UUID_REFERENCE_INPUT:
+            await client.notify(await read_gatt_char(uuid))
+
+    client.write_gatt_char = write_and_notify
+
+    async with desk:
+        await desk.move_to_target(0.7)
+        assert abs(await desk.get_height() - 0.7) < 0.001
+
+    # only the initial height read, the loop relies on notifications
+    # and the final height is served from the latest one
+    assert client.read_gatt_char.await_count == 1
+
+
+async def test_move_to_target_stale_notification():
+    desk = IdasenDesk(mac=desk_mac)
+    client = MockBleakClient()
+    desk._client = client
+    write_gatt_char = client.write_gatt_char
+    reference_inputs = 0
+
+    async def write_and_notify(uuid: str, data: bytearray, response: bool = False):
+        nonlocal reference_inputs
+        # the sample at rest is notified after the desk has started moving
+        stale = await client.read_gatt_char(uuid)
+        await write_gatt_char(uuid, data, response)
+        if uuid == idasen._UUID_REFERENCE_INPUT:
+            reference_inputs += 1
+            if reference_inputs == 1:
+                await client.notify(stale)
+
+    client.write_gatt_char = write_and_notify
+
+    async with desk:
+        await desk.move_to_target(0.7)
+        assert abs(await desk.get_height() - 0.7) < 0.001
+
+
+async def test_get_height_cached():
+    desk = IdasenDesk(mac=desk_mac)
+    client = MockBleakClient()
+    desk._client = client
+    client.read_gatt_char = mock.AsyncMock(side_effect=client.read_gatt_char)
+
+    async with desk:
+        assert await desk.get_height() == await desk.get_height()
+        assert client.read_gatt_char.await_count == 1
+
+        # commands invalidate the cached height
+        await desk.move_up()
+        assert await desk.get_height() > 1.0
+        assert client.read_gatt_char.await_count == 2
+
+
+async def test_move_to_target_cached():
+    desk = IdasenDesk(mac=desk_mac)
+    client = MockBleakClient()
+    desk._client = client
+    client.read_gatt_char = mock.AsyncMock(side_effect=client.read_gatt_char)
+    client.write_gatt_char = mock.AsyncMock()
+
+    async with desk:
+        height = await desk.get_height()
+        client.write_gatt_char.reset_mock()
+        # still at rest at the target, no need to read the height again
+        await desk.move_to_target(height)
+        assert client.read_gatt_char.await_count == 1
+        client.write_gatt_char.assert_not_awaited()
+
+
 async def test_move_abort_when_no_movement():
     desk = IdasenDesk(mac=desk_mac)
     client = MockBleakClient()
@@ -218,40 +403,113 @@ async def test_move_stop():
     client = MockBleakClient()
     desk._client = client
     client.write_gatt_char = mock.AsyncMock()
+    started = asyncio.Event()
 
     async def write_gatt_char_mock(
         uuid: str, command: bytearray, response: bool = False
     ):
-        if client.write_gatt_char.call_count == 4:
+        if (
+            uuid == idasen._UUID_REFERENCE_INPUT
+            and command != idasen._COMMAND_REFERENCE_INPUT_STOP
+        ):
             assert desk.is_moving
+            started.set()
         # Force this method to behave asynchronously, otherwise it will block the
         # eventloop
-        await asyncio.sleep(0.1)
+        await asyncio.sleep(0)
 
     client.write_gatt_char.side_effect = write_gatt_char_mock
 
     async with desk:
         move_task = asyncio.create_task(desk.move_to_target(0.7))
-        # Allow the move_task to start looping
-        await asyncio.sleep(0.1)
+        # Wait for the move_task to send its first reference input
+        await started.wait()
 
         await desk.stop()
         assert not desk.is_moving
         assert move_task.done()
+        assert not move_task.cancelled()
+        stop_calls = [
+            mock.call(idasen._UUID_COMMAND, idasen._COMMAND_STOP, response=False),
+            mock.call(
+                idasen._UUID_REFERENCE_INPUT,
+                idasen._COMMAND_REFERENCE_INPUT_STOP,
+                response=False,
+            ),
+        ]
+        assert client.write_gatt_char.call_args_list[-2:] == stop_calls
+        # sent once, by the cancelled move
+        assert client.write_gatt_char.call_args_list[-4:-2] != stop_calls
+
+
+async def test_move_stop_before_start():
+    desk = IdasenDesk(mac=desk_mac)
+    client = MockBleakClient()
+    desk._client = client
+
+    async with desk:
+        client.write_gatt_char = mock.AsyncMock()
+        move_task = asyncio.create_task(desk.move_to_target(0.7))
+        # let move_to_target create the move task, but not run it
+        await asyncio.sleep(0)
+        assert desk._move_task is not None
+
+        await desk.stop()
+        await move_task
+        assert client.write_gatt_char.call_args_list == [
+            mock.call(idasen._UUID_COMMAND, idasen._COMMAND_STOP, response=False),
+            mock.call(
+                idasen._UUID_REFERENCE_INPUT,
+                idasen._COMMAND_REFERENCE_INPUT_STOP,
+                response=False,
+            ),
+        ]
+
+
+async def test_move_timeout(caplog, monkeypatch):
+    monkeypatch.setattr(IdasenDesk, "MOVE_TIMEOUT", 0.5)
+    caplog.set_level("ERROR")
+    desk = IdasenDesk(mac=desk_mac)
+    client = MockBleakClient()
+    desk._client = client
+    # the desk never reaches the target
+    client.write_gatt_char = mock.AsyncMock()
+    client._is_moving = True
+
+    async with desk:
+        await desk.move_to_target(0.7)
+        assert not desk.is_moving
+
+    assert client.write_gatt_char.call_args_list[-2:] == [
+        mock.call(idasen._UUID_COMMAND, idasen._COMMAND_STOP, response=False),
+        mock.call(
+            idasen._UUID_REFERENCE_INPUT,
+            idasen._COMMAND_REFERENCE_INPUT_STOP,
+            response=False,
+        ),
+    ]
+    assert caplog.messages[-1] == (
+        "[AA:AA:AA:AA:AA:AA] Failed to reach target within 0.5 seconds"
+    )
 
 
 @pytest.mark.parametrize(
-    "raw, height, speed",
+    "meters, raw",
     [
-        (bytearray([0x64, 0x19, 0x00, 0x00]), IdasenDesk.MAX_HEIGHT, 0),
-        (bytearray([0x00, 0x00, 0x00, 0x00]), IdasenDesk.MIN_HEIGHT, 0),
-        (bytearray([0x51, 0x04, 0x00, 0x00]), 0.7305, 0),
-        (bytearray([0x08, 0x08, 0x00, 0x00]), 0.8256, 0),
-        (bytearray([0x08, 0x08, 0x02, 0x01]), 0.8256, 0.0258),
+        (IdasenDesk.MIN_HEIGHT, b"\x00\x00"),
+        (IdasenDesk.MAX_HEIGHT, b"\x64\x19"),
+        (0.7305, b"\x51\x04"),
+        # 0.6204 * 10000 is just below 6204
+        (0.6204, b"\x04\x00"),
     ],
 )
-def test_bytes_to_meters_and_speed(raw: bytearray, height: float, speed: int):
-    assert _bytes_to_meters_and_speed(raw) == (height, speed)
+def test_meters_to_bytes(meters: float, raw: bytes):
+    assert _meters_to_bytes(meters) == raw
+
+
+@pytest.mark.parametrize("raw, height, speed", _BYTES_TO_METERS_CASES)
+def test_bytes_to_meters_and_speed(raw: bytes, height: float, speed: float):
+    assert _bytes_to_meters_and_speed(bytearray(raw)) == (height, speed)
 
 
 async def test_fail_to_connect(caplog, monkeypatch):
@@ -259,7 +517,8 @@ async def test_fail_to_connect(caplog, monkeypatch):
         raise Exception
 
     # patch `asyncio.sleep()` to prevent making the tests unnecessarily long.
-    monkeypatch.setattr(asyncio, "sleep", mock.AsyncMock())
+    sleep = asyncio.sleep
+    monkeypatch.setattr(asyncio, "sleep", lambda *_: sleep(0))
 
     caplog.set_level("WARNING")
 
@@ -282,31 +541,35 @@ async def test_fail_to_connect(caplog, monkeypatch):
     caplog.clear()
 
 
-async def test_discover_exception():
-    with mock.patch.object(
-        bleak.BleakScanner, "find_device_by_filter", side_effect=Exception
-    ) as mock_discover:
-        result = await IdasenDesk.discover()
-        mock_discover.assert_awaited_once_with(idasen._is_desk)
-        assert result is None
+# function scoped so call records do not carry over between tests,
+# unlike a session wide patch in conftest.py
+@pytest.fixture
+def mock_discover(monkeypatch) -> mock.AsyncMock:
+    find_device_by_filter = mock.AsyncMock()
+    monkeypatch.setattr(
+        bleak.BleakScanner, "find_device_by_filter", find_device_by_filter
+    )
+    return find_device_by_filter
+
+
+async def test_discover_exception(mock_discover: mock.AsyncMock):
+    mock_discover.side_effect = Exception
+    result = await IdasenDesk.discover()
+    mock_discover.assert_awaited_once_with(
+        idasen._is_desk, service_uuids=[idasen._UUID_ADV_SVC]
+    )
+    assert result is None
 
 
-async def test_discover_empty():
-    with mock.patch.object(
-        bleak.BleakScanner, "find_device_by_filter", return_value=None
-    ) as mock_discover:
-        result = await IdasenDesk.discover()
-        mock_discover.assert_awaited_once_with(idasen._is_desk)
-        assert result is None
+async def test_discover_empty(mock_discover: mock.AsyncMock):
+    mock_discover.return_value = None
+    result = await IdasenDesk.discover()
+    mock_discover.assert_awaited_once_with(
+        idasen._is_desk, service_uuids=[idasen._UUID_ADV_SVC]
+    )
+    assert result is None
 
 
-@pytest.mark.parametrize(
-    "adv, is_desk",
-    [
-        (SimpleNamespace(service_uuids=[]), False),
-        (SimpleNamespace(service_uuids=["foo"]), False),
-        (SimpleNamespace(service_uuids=["foo", idasen._UUID_ADV_SVC, "bar"]), True),
-    ],
-)
+@pytest.mark.parametrize("adv, is_desk", _IS_DESK_CASES)
 def test_is_desk(adv: SimpleNamespace, is_desk: bool):
     assert _is_desk(None, adv) is is_desk  # type: ignore